@@ -1,69 +1,236 @@
+import asyncio
+import datetime
 import os
+import shutil
+import sys
+import time
+import uuid
 import yaml
 import json
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    # libyaml bindings aren't available, fall back to the pure-Python parser
+    from yaml import SafeLoader as _Loader
+
+try:
+    import orjson
+except ImportError:
+    # Optional (not in requirements.txt), speeds up compact output,
+    # the stdlib json encoder is used when orjson isn't installed
+    orjson = None
+
+try:
+    import aiohttp
+except ImportError:
+    # Optional (not in requirements.txt), lets generate_json_specs download every spec on one event loop,
+    # it sticks to the requests thread pool when aiohttp isn't installed
+    aiohttp = None
 
 INTEGRATIONS_CORE_SOURCE = "https://raw.githubusercontent.com/DataDog/integrations-core/refs/heads/master"
 SCHEMA_OUTPUT_DIRECTORY = "./schema_files"
 SPEC_FILE_PATH = "/assets/configuration/spec.yaml"
+SPEC_CACHE_DIRECTORY = "./.cache/specs"
+SPEC_CACHE_TTL = 24 * 60 * 60  # seconds before a cached spec yaml is fetched again
+MAX_WORKERS = 16
+MAX_ASYNC_DOWNLOADS = 32  # concurrent spec downloads on the aiohttp path, keeps GitHub's raw CDN happy
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # bytes read at a time from a streamed spec download on the aiohttp path
+OUTPUT_BUFFER_SIZE = 1 << 20  # 1 MiB write buffer for the generated json schemas
+
+# Keys written into every generated property node, shared by all of them
+_K_DESC = sys.intern("description")
+_K_EX = sys.intern("example")
+_K_TYPE = sys.intern("type")
+_K_PROPS = sys.intern("properties")
+
+# Top level of every generated schema, title and properties are filled in per integration on a shallow copy
+_SKELETON = {
+    "$schema": "https://json-schema.org/draft/2020-12/schema#",
+    "title": None,
+    "type": "object",
+    "properties": None,
+    "required": ("init_config", "instances"),  # tuple so the copies can't share a mutable list, made a list per schema
+    "additionalProperties": False
+}
+
+# Spec value types that need typecasting to their JSON schema equivalent, anything else is passed through
+_TYPE_TABLE = {
+    "integer": "number",
+    "double": "number",
+    "float": "number",
+    "decimal": "number",
+}
+
+# Shared keep-alive pool so every spec download after the first reuses the same TLS connection(s)
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS))
 
 def rec_generate_nodes(current_node):
-    """ Recursively iterates down the Datadog spec yaml tree, generating the JSON schema nodes 
+    """ Iterates down the Datadog spec yaml tree, generating the JSON schema nodes. Walks the tree
+    with an explicit stack instead of recursing so deeply nested specs can't hit the recursion limit
     """
     if not "options" in current_node:
         return
 
-    current_properties = {}
+    root_properties = {}
+    # Spec nodes still to visit, paired with the properties dict their options get written into
+    stack = [(current_node, root_properties)]
+
+    while stack:
+        spec_node, current_properties = stack.pop()
+
+        for property in spec_node["options"]:
+            prop_name = property.get("name")
+            if prop_name is None:
+                # There is an 'overrides' property I'm going to ignore for now cause I don't know what it does
+                continue
+
+            node = current_properties[prop_name] = {}
+
+            # Parsing out the properties from the spec yaml:
+            description = property.get("description")
+            if description is not None:
+                node[_K_DESC] = description if type(description) is str else str(description)
+
+            value = property.get("value")
+            if value is not None:
+                example = value.get("example")
+                if example:
+                    node[_K_EX] = example
 
-    for property in current_node["options"]:
-        try:
-            prop_name = property["name"] 
-        except:
-            # There is an 'overrides' property I'm going to ignore for now cause I don't know what it does
-            continue
-
-        current_properties[prop_name] = {}
-
-        # Parsing out the properties from the spec yaml:
-        if "description" in property:
-            current_properties[prop_name]["description"] = str(property["description"])
-            
-        if "value" in property:
-            if "example" in property["value"] and property["value"]["example"]:
-                current_properties[prop_name]["example"] = property["value"]["example"]
-            
-            if "type" in property["value"]:
                 # typecasting specific values
-                prop_type = property["value"]["type"]
-                if prop_type in ["integer", "double", "float", "decimal"]:
-                    prop_type = "number"
-                current_properties[prop_name]["type"] = prop_type
+                prop_type = value.get("type")
+                if prop_type is not None:
+                    node[_K_TYPE] = _TYPE_TABLE.get(prop_type, prop_type)
 
-        # Make a recursive call downward if there is a list of sub-properties:
-        if "options" in property:
-            inner_properties = rec_generate_nodes(property) # not tail recursive but im lazy :)
-            current_properties[prop_name]["properties"] = inner_properties
-            current_properties[prop_name]["type"] = "anyOf"
+            # Queue the list of sub-properties, they get filled into inner_properties once popped:
+            if "options" in property:
+                inner_properties = {}
+                node[_K_PROPS] = inner_properties
+                node[_K_TYPE] = "anyOf"
+                stack.append((property, inner_properties))
 
-    return current_properties
+    return root_properties
 
-def generate_json_spec(integration_name, output_directory = SCHEMA_OUTPUT_DIRECTORY):
-    """ Generates a json spec from a datadog spec yaml file
+def _locate_spec(integration_name):
+    """ Returns where the integration's spec yaml is cached and, when that copy is missing or older than
+    SPEC_CACHE_TTL, the URL to download it from (None when the cached copy can be used as is)
     """
+    cache_path = os.path.join(SPEC_CACHE_DIRECTORY, f"{integration_name}.yaml")
+
+    try:
+        if time.time() - os.path.getmtime(cache_path) < SPEC_CACHE_TTL:
+            return cache_path, None
+    except OSError:
+        pass
 
     url_path = f"{INTEGRATIONS_CORE_SOURCE}/{integration_name}/{SPEC_FILE_PATH}"
     print(url_path)
-    response = requests.get(url_path)
+    return cache_path, url_path
+
+@contextmanager
+def _atomic_open(path, mode = "wb", **kwargs):
+    """ Opens a uniquely named temporary file next to path and moves it over path once the block
+    finishes, so concurrent writers and interrupted runs never leave a partial file at path.
+    The temporary file is removed if the block raises.
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    # O_EXCL so no other writer can share the file, 0o666 so the umask applies the same way as with a plain open()
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666)
+    try:
+        fp = open(fd, mode, **kwargs)
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp_path)
+        raise
+
+    try:
+        with fp:
+            yield fp
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+@contextmanager
+def _open_cache(cache_path, response):
+    """ Checks a spec yaml download succeeded and opens its cache file for writing. The new copy only
+    replaces the cached one once the block finishes, so an interrupted download can't look fresh
+    """
     response.raise_for_status()  # Raise an exception for bad status codes
+    os.makedirs(SPEC_CACHE_DIRECTORY, exist_ok=True)
+    with _atomic_open(cache_path) as fp_cache:
+        yield fp_cache
+
+def _fetch(integration_name):
+    """ Makes sure an up to date copy of the integration's spec yaml is in SPEC_CACHE_DIRECTORY,
+    downloading it if the cached copy is missing or older than SPEC_CACHE_TTL. Returns its path.
+    """
+    cache_path, url_path = _locate_spec(integration_name)
 
+    if url_path is not None:
+        # Stream the body straight to disk rather than buffering the whole spec in memory first
+        with _SESSION.get(url_path, stream=True) as response, _open_cache(cache_path, response) as fp_cache:
+            response.raw.decode_content = True
+            shutil.copyfileobj(response.raw, fp_cache)
+
+    return cache_path
+
+async def _fetch_one(session, semaphore, integration_name):
+    """ aiohttp counterpart of _fetch, the spec is then parsed in a worker thread so the
+    event loop keeps serving the other downloads
+    """
+    cache_path, url_path = _locate_spec(integration_name)
+
+    if url_path is not None:
+        async with semaphore, session.get(url_path) as response:
+            with _open_cache(cache_path, response) as fp_cache:
+                # Streamed to disk like in _fetch, each write is just a copy into the file buffer so it stays on the loop
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    fp_cache.write(chunk)
+
+    # Parses from the cache populated above and memoizes it for generate_json_spec
+    return await asyncio.to_thread(_load_spec, integration_name)
+
+async def _async_fetch_all(integration_names):
+    """ Downloads and parses the spec yamls of all the integrations on a single event loop
+    """
+    semaphore = asyncio.Semaphore(MAX_ASYNC_DOWNLOADS)
+    async with aiohttp.ClientSession() as session:
+        return await asyncio.gather(*[_fetch_one(session, semaphore, name) for name in integration_names])
+
+@lru_cache(maxsize=None)
+def _load_spec(integration_name):
+    """ Fetches and parses the Datadog spec yaml for an integration, memoized in memory
+    and backed by the on-disk copy managed by _fetch
+    """
     # Load the YAML content
-    config_spec = yaml.safe_load(response.text)    
-    input_spec = {}
+    with open(_fetch(integration_name), "rb") as fp_cache:
+        return yaml.load(fp_cache, Loader=_Loader)
+
+def _json_default(value):
+    """ Serializes the non-JSON values the YAML loader can produce in spec examples, shared by both encoders
+    """
+    # YAML timestamps (e.g. `example: 2020-01-01`) come back as date/datetime objects
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
 
+def _emit(integration_name, config_spec, output_directory = SCHEMA_OUTPUT_DIRECTORY, compact = False):
+    """ Converts a parsed datadog spec yaml into a json schema and writes it to output_directory,
+    indented for readability unless compact is set
+    """
     # Drill down to just the relevant fields:
-    for spec_file in config_spec["files"]:
-        if f"{integration_name}.yaml" == spec_file["name"]:
-            input_spec = spec_file["options"]
+    spec_file_name = f"{integration_name}.yaml"
+    input_spec = next((spec_file["options"] for spec_file in config_spec["files"] if spec_file["name"] == spec_file_name), None)
+    if input_spec is None:
+        raise KeyError(f"No {spec_file_name} entry in the {integration_name} spec files")
 
     # Breaking out the spec file into its two main template sections, init_config, instances
     init_config, instances = input_spec[0], input_spec[1]
@@ -73,32 +240,66 @@ def generate_json_spec(integration_name, output_directory = SCHEMA_OUTPUT_DIRECT
     instance_properties = rec_generate_nodes(instances)
     
     
-    output_json = {
-        "$schema": "https://json-schema.org/draft/2020-12/schema#",
-        "title": f"{integration_name} integration schema",
-        "type": "object",
-        "properties": {
-            "init_config": {
-                "type": ["object", "null"],
-                "properties": init_config_properties,
-            },
-            "instances": {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": instance_properties,
-                }
-            },
+    output_json = _SKELETON.copy()
+    output_json["title"] = f"{integration_name} integration schema"
+    output_json["required"] = list(_SKELETON["required"])
+    output_json["properties"] = {
+        "init_config": {
+            "type": ["object", "null"],
+            "properties": init_config_properties,
+        },
+        "instances": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": instance_properties,
+            }
         },
-        "required": ["init_config", "instances"],
-        "additionalProperties": False
     }
 
     #pprint.pprint(output_json)
     # Writing the output.json
-    with open(os.path.join(SCHEMA_OUTPUT_DIRECTORY, f"{integration_name}.json"), "w") as fp_out:
-        json.dump(output_json, fp_out, indent=2)
+    # Written to a temporary file first and swapped in, so a crash never leaves a half written schema behind
+    output_path = os.path.join(output_directory, f"{integration_name}.json")
+    # The indented schemas are the ones committed to the repo, so they always go through the stdlib encoder and
+    # come out the same on every machine. orjson only speeds up the opt-in compact output.
+    encoded = None
+    if compact and orjson is not None:
+        try:
+            encoded = orjson.dumps(output_json, default=_json_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+        except orjson.JSONEncodeError:
+            # e.g. integers beyond 64 bits, leave it to the stdlib encoder below
+            pass
+
+    if encoded is not None:
+        with _atomic_open(output_path, "wb", buffering=OUTPUT_BUFFER_SIZE) as fp_out:
+            fp_out.write(encoded)
+    else:
+        with _atomic_open(output_path, "w", buffering=OUTPUT_BUFFER_SIZE, encoding="utf-8") as fp_out:
+            if compact:
+                # ensure_ascii=False to match the raw UTF-8 orjson writes
+                json.dump(output_json, fp_out, ensure_ascii=False, default=_json_default, separators=(",", ":"))
+            else:
+                json.dump(output_json, fp_out, default=_json_default, indent=2)
+
+def generate_json_spec(integration_name, output_directory = SCHEMA_OUTPUT_DIRECTORY, compact = False):
+    """ Generates a json spec from a datadog spec yaml file
+    """
+    _emit(integration_name, _load_spec(integration_name), output_directory, compact)
+
+def generate_json_specs(integration_names, output_directory = SCHEMA_OUTPUT_DIRECTORY, compact = False):
+    """ Generates the json specs for several integrations concurrently, sharing one connection pool
+    """
+    # Each integration once, duplicates would only race each other on the same download and output file
+    integration_names = list(dict.fromkeys(integration_names))
+
+    if aiohttp is not None:
+        # Fetch everything on one event loop up front, the workers below then hit _load_spec's cache
+        asyncio.run(_async_fetch_all(integration_names))
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # list() so any exception raised in a worker is re-raised here
+        list(executor.map(lambda name: generate_json_spec(name, output_directory, compact), integration_names))
 
 if __name__ == '__main__':
-    generate_json_spec("disk")
-    generate_json_spec("redisdb")
+    generate_json_specs(["disk", "redisdb"])